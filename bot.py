@@ -1,19 +1,33 @@
+import asyncio
 import logging
+import multiprocessing
 import os
+import struct
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
+from urllib.parse import urlparse
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
+from telegram.request import HTTPXRequest
 
-import qrcode
-from PIL import Image, ImageColor
-import io
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime
-from sqlalchemy.orm import sessionmaker, declarative_base
+import segno
+from PIL import ImageColor
+from sqlalchemy import Column, Index, Integer, String, Text, DateTime, bindparam, make_url, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.orm import declarative_base
 
 # === Настройки ===
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 DB_URL = os.getenv("DATABASE_URL")
+# Если задан WEBHOOK_URL — работаем через вебхук (прод), иначе long polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None
+PORT = int(os.getenv("PORT", 8443))
 
 if not DB_URL:
     raise ValueError("DATABASE_URL не найден. Проверь переменные окружения!")
@@ -46,76 +60,193 @@ class QRHistory(Base):
     bg_color = Column(String)
     created_at = Column(DateTime, default=datetime.utcnow)
 
-# === Подключение к БД ===
-engine = create_engine(DB_URL)
-Base.metadata.create_all(engine)
-Session = sessionmaker(bind=engine)
-
-# === Клавиатуры ===
-def main_keyboard():
-    keyboard = [
-        [InlineKeyboardButton("🆕 Создать QR-код", callback_data="create_qr")],
-        [InlineKeyboardButton("📜 История", callback_data="show_history")],
-        [InlineKeyboardButton("ℹ️ Помощь", callback_data="help")],
-        [InlineKeyboardButton("❤️ Поддержать создателя", callback_data="donate")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
-
-def back_to_menu_keyboard():
-    keyboard = [
-        [InlineKeyboardButton("🏡 Главное меню", callback_data="main_menu")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+    # Под выборку истории: WHERE user_id = ? ORDER BY created_at DESC LIMIT 5
+    __table_args__ = (Index('ix_history_user_created', user_id, created_at.desc()),)
 
-def get_color_keyboard():
-    keyboard = [
-        [InlineKeyboardButton(text, callback_data=f"color|{fc}|{bc}")]
-        for text, (fc, bc) in COLORS.items()
+# === Подключение к БД ===
+def _async_db_url(url):
+    # postgresql://... из .env → асинхронный драйвер asyncpg
+    url = make_url(url)
+    if url.drivername in ("postgresql", "postgresql+psycopg2"):
+        url = url.set(drivername="postgresql+asyncpg")
+    return url
+
+
+engine = create_async_engine(
+    _async_db_url(DB_URL),
+    pool_size=20,
+    pool_pre_ping=True,
+    pool_recycle=1800,
+    query_cache_size=1200,
+)
+Session = async_sessionmaker(engine, expire_on_commit=False)
+
+# Последние 5 QR-кодов пользователя: строки-кортежи без ORM-объектов
+_HISTORY_STMT = (
+    select(QRHistory.data, QRHistory.fill_color, QRHistory.bg_color, QRHistory.created_at)
+    .where(QRHistory.user_id == bindparam("uid"))
+    .order_by(QRHistory.created_at.desc())
+    .limit(5)
+)
+
+
+def _create_schema(conn):
+    Base.metadata.create_all(conn)
+    # create_all не трогает уже существующие таблицы — индексы докидываем отдельно
+    for index in QRHistory.__table__.indexes:
+        index.create(conn, checkfirst=True)
+
+
+async def init_db(application):
+    global _history_flusher_task, _QR_POOL
+    async with engine.begin() as conn:
+        await conn.run_sync(_create_schema)
+    _history_flusher_task = asyncio.create_task(_history_flusher())
+    _QR_POOL = _new_qr_pool()
+
+
+async def close_db(application):
+    # Не отменяем флашер посреди INSERT, а просим его выйти и ждём
+    _history_stop.set()
+    if _history_flusher_task:
+        await _history_flusher_task
+    await _flush_history()
+    await engine.dispose()
+    if _QR_POOL:
+        _QR_POOL.shutdown(wait=False, cancel_futures=True)
+
+
+async def _ensure_user(user_id, name):
+    # Один INSERT вместо SELECT + INSERT, повторный /start ничего не делает
+    stmt = insert(User).values(user_id=user_id, name=name).on_conflict_do_nothing(index_elements=['user_id'])
+    async with Session.begin() as session:
+        await session.execute(stmt)
+
+
+async def _fetch_history(user_id):
+    # Сначала дописываем буфер, чтобы только что созданные QR-коды попали в историю
+    await _flush_history()
+    async with Session.begin() as session:
+        return (await session.execute(_HISTORY_STMT, {"uid": user_id})).all()
+
+
+# === Буфер истории: пишем в БД пачками раз в HISTORY_FLUSH_INTERVAL секунд ===
+HISTORY_FLUSH_INTERVAL = 3
+HISTORY_BUFFER_LIMIT = 10_000
+
+# При переполнении deque сам выкидывает самые старые записи
+_history_buffer = deque(maxlen=HISTORY_BUFFER_LIMIT)
+# Одновременно идёт только один сброс: _fetch_history дожидается уже начатого
+_history_flush_lock = asyncio.Lock()
+_history_stop = asyncio.Event()
+_history_flusher_task = None
+
+
+def _save_history(user_id, data, fill_color, bg_color):
+    _history_buffer.append({
+        "user_id": user_id,
+        "data": data,
+        "fill_color": fill_color,
+        "bg_color": bg_color,
+        "created_at": datetime.utcnow(),
+    })
+
+
+async def _flush_history():
+    async with _history_flush_lock:
+        if not _history_buffer:
+            return
+        batch = list(_history_buffer)
+        _history_buffer.clear()
+        try:
+            async with Session.begin() as session:
+                await session.execute(insert(QRHistory), batch)
+        except Exception:
+            logging.exception("Не удалось сохранить историю, повторим позже")
+            # Возвращаем пачку перед новыми записями; при переполнении deque отбросит самые старые
+            pending = batch + list(_history_buffer)
+            _history_buffer.clear()
+            _history_buffer.extend(pending)
+
+
+async def _history_flusher():
+    while not _history_stop.is_set():
+        try:
+            await asyncio.wait_for(_history_stop.wait(), timeout=HISTORY_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        await _flush_history()
+
+
+# === Клавиатуры (неизменяемые, собираем один раз при запуске) ===
+MAIN_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🆕 Создать QR-код", callback_data="create_qr")],
+    [InlineKeyboardButton("📜 История", callback_data="show_history")],
+    [InlineKeyboardButton("ℹ️ Помощь", callback_data="help")],
+    [InlineKeyboardButton("❤️ Поддержать создателя", callback_data="donate")]
+])
+
+BACK_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🏡 Главное меню", callback_data="main_menu")]
+])
+
+# В callback_data кладём только индекс пресета: "c0", "c1", ...
+_COLOR_LIST = list(COLORS.values())
+
+COLOR_KB = InlineKeyboardMarkup(
+    [
+        [InlineKeyboardButton(text, callback_data=f"c{i}")]
+        for i, text in enumerate(COLORS)
     ]
-    keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data="back_to_menu")])
-    return InlineKeyboardMarkup(keyboard)
+    + [[InlineKeyboardButton("⬅️ Назад", callback_data="back_to_menu")]]
+)
 
 
 # === Универсальная функция для отправки сообщений с кнопкой "Главное меню" ===
 async def send_with_main_menu(context: ContextTypes.DEFAULT_TYPE, update: Update, message: str):
     if update.message:
-        await update.message.reply_text(message, reply_markup=back_to_menu_keyboard(), parse_mode='Markdown')
+        await update.message.reply_text(message, reply_markup=BACK_KB, parse_mode='Markdown')
     elif update.callback_query:
         try:
-            await update.callback_query.edit_message_text(message, reply_markup=back_to_menu_keyboard(), parse_mode='Markdown')
+            await update.callback_query.edit_message_text(message, reply_markup=BACK_KB, parse_mode='Markdown')
         except Exception as e:
             if "message is not modified" in str(e).lower():
                 pass  # Просто игнорируем повторное редактирование
             else:
                 await update.callback_query.edit_message_caption(
                     caption=message,
-                    reply_markup=back_to_menu_keyboard(),
+                    reply_markup=BACK_KB,
                     parse_mode='Markdown'
                 )
 
 
-# === Команда /start — только здесь показываем лого (если нужно) ===
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user = update.effective_user
-    session = Session()
-
-    db_user = session.query(User).filter_by(user_id=str(user.id)).first()
-    if not db_user:
-        db_user = User(user_id=str(user.id), name=user.first_name)
-        session.add(db_user)
-        session.commit()
-
-    welcome_text = f"""
-👋 Привет, {user.first_name}!
-
+# === Приветствие главного меню ===
+# Разметки в тексте нет, поэтому отправляем без parse_mode
+_WELCOME_BODY = """
 Всё просто: кидаешь ссылку, я отправляю тебе QR-код.
 Выбирай действие ниже 👇👇👇
 """
+_WELCOME_TEXT = "\n👋 Привет!\n" + _WELCOME_BODY
+
+
+async def _show_main_menu(query):
+    try:
+        await query.edit_message_text(_WELCOME_TEXT, reply_markup=MAIN_KB)
+    except Exception as e:
+        if "message is not modified" in str(e).lower():
+            pass
+        else:
+            await query.edit_message_caption(caption=_WELCOME_TEXT, reply_markup=MAIN_KB)
+
+
+# === Команда /start — только здесь показываем лого (если нужно) ===
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    await _ensure_user(str(user.id), user.first_name)
 
     await update.message.reply_text(
-        text=welcome_text,
-        reply_markup=main_keyboard(),
-        parse_mode='Markdown'
+        text=f"\n👋 Привет, {user.first_name}!\n" + _WELCOME_BODY,
+        reply_markup=MAIN_KB
     )
 
 
@@ -126,19 +257,18 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if query.data == "create_qr":
         try:
-            await query.edit_message_text("Выберите цвета:", reply_markup=get_color_keyboard())
+            await query.edit_message_text("Выберите цвета:", reply_markup=COLOR_KB)
         except Exception as e:
             logging.warning(f"Не удалось изменить текстовое сообщение: {e}")
-            await query.edit_message_caption("Выберите цвета:", reply_markup=get_color_keyboard())
+            await query.edit_message_caption("Выберите цвета:", reply_markup=COLOR_KB)
 
     elif query.data == "show_history":
-        session = Session()
-        history = session.query(QRHistory).filter_by(user_id=str(query.from_user.id)).order_by(QRHistory.created_at.desc()).limit(5).all()
+        history = await _fetch_history(str(query.from_user.id))
 
         if history:
             msg = "📜 Твоя история последних 5 QR-кодов:\n\n"
-            for item in history:
-                msg += f"🔗 `{item.data}`\n🎨 {item.fill_color} | {item.bg_color}\n🕒 {item.created_at.strftime('%d.%m %H:%M')}\n\n"
+            for data, fill_color, bg_color, created_at in history:
+                msg += f"🔗 `{data}`\n🎨 {fill_color} | {bg_color}\n🕒 {created_at.strftime('%d.%m %H:%M')}\n\n"
         else:
             msg = "🚫 У вас пока нет истории."
 
@@ -170,19 +300,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await send_with_main_menu(context, update, donate_text)
 
     elif query.data == "main_menu":
-        welcome_text = """
-👋 Привет!
-
-Всё просто: кидаешь ссылку, я отправляю тебе QR-код.
-Выбирай действие ниже 👇👇👇
-"""
-        try:
-            await query.edit_message_text(welcome_text, reply_markup=main_keyboard(), parse_mode='Markdown')
-        except Exception as e:
-            if "message is not modified" in str(e).lower():
-                pass
-            else:
-                await query.edit_message_caption(caption=welcome_text, reply_markup=main_keyboard(), parse_mode='Markdown')
+        await _show_main_menu(query)
 
 
 # === Обработка выбора цвета и возврата в меню ===
@@ -190,79 +308,136 @@ async def color_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     query = update.callback_query
     await query.answer()
 
-    if query.data.startswith("color"):
-        _, fill_color, bg_color = query.data.split("|")
+    if query.data == "back_to_menu":
+        await _show_main_menu(query)
+
+    else:
+        index = int(query.data[1:])
+        if index >= len(_COLOR_LIST):
+            return  # Устаревшая или подделанная кнопка
+        fill_color, bg_color = _COLOR_LIST[index]
         context.user_data['fill_color'] = fill_color
         context.user_data['bg_color'] = bg_color
 
         msg = "✅ Цвет выбран. Отправьте текст для QR-кода."
         await send_with_main_menu(context, update, msg)
 
-    elif query.data == "back_to_menu":
-        welcome_text = """
-👋 Привет!
 
-Всё просто: кидаешь ссылку, я отправляю тебе QR-код.
-Выбирай действие ниже 👇👇👇
-"""
-        try:
-            await query.edit_message_text(welcome_text, reply_markup=main_keyboard(), parse_mode='Markdown')
-        except Exception as e:
-            if "message is not modified" in str(e).lower():
-                pass
-            else:
-                await query.edit_message_caption(caption=welcome_text, reply_markup=main_keyboard(), parse_mode='Markdown')
+# === Функция генерации QR-кода ===
+QR_BOX_SIZE = 10
+QR_BORDER = 4
 
+# Цвета из COLORS разбираем один раз при запуске
+_RGB_CACHE = {name: ImageColor.getrgb(name) for pair in COLORS.values() for name in pair}
 
-# === Функция генерации QR-кода ===
-def generate_qr(data, fill_color="black", bg_color="white"):
-    try:
-        fill = ImageColor.getrgb(fill_color)
-        background = ImageColor.getrgb(bg_color)
-    except ValueError:
-        return None
-
-    qr = qrcode.QRCode(
-        version=1,
-        error_correction=qrcode.constants.ERROR_CORRECT_H,
-        box_size=10,
-        border=4,
+
+def _png_chunk(tag, payload):
+    return struct.pack(">I", len(payload)) + tag + payload + struct.pack(">I", zlib.crc32(tag + payload))
+
+
+def _matrix_to_png(matrix, box_size, border, fill, background):
+    # Палитровый 1-битный PNG: индекс 0 — фон, 1 — модуль QR-кода
+    size = (len(matrix) + 2 * border) * box_size
+    row_bytes = (size + 7) // 8
+    dark, light = "1" * box_size, "0" * box_size
+    margin = light * border
+
+    blank = (b"\x00" + bytes(row_bytes)) * (border * box_size)
+    scanlines = [blank]
+    for row in matrix:
+        bits = (margin + "".join(dark if cell else light for cell in row) + margin).ljust(row_bytes * 8, "0")
+        scanlines.append((b"\x00" + int(bits, 2).to_bytes(row_bytes, "big")) * box_size)
+    scanlines.append(blank)
+
+    png = [
+        b"\x89PNG\r\n\x1a\n",
+        _png_chunk(b"IHDR", struct.pack(">IIBBBBB", size, size, 1, 3, 0, 0, 0)),
+        _png_chunk(b"PLTE", bytes(background[:3]) + bytes(fill[:3])),
+        _png_chunk(b"IDAT", zlib.compress(b"".join(scanlines))),
+        _png_chunk(b"IEND", b""),
+    ]
+    return b"".join(png)
+
+
+def generate_qr_bytes(data, fill_color, bg_color):
+    # Выполняется в процессе из _QR_POOL, поэтому функция на уровне модуля и возвращает bytes
+    fill = _RGB_CACHE.get(fill_color) or ImageColor.getrgb(fill_color)
+    background = _RGB_CACHE.get(bg_color) or ImageColor.getrgb(bg_color)
+
+    qr = segno.make(data, error='h', micro=False, encoding='utf-8')
+    return _matrix_to_png(qr.matrix, QR_BOX_SIZE, QR_BORDER, fill, background)
+
+
+# Генерация QR упирается в CPU — выносим её в отдельные процессы, чтобы не блокировать event loop.
+# Пул создаётся в init_db: при импорте модуля (в том числе в самих воркерах) его нет
+_QR_POOL = None
+
+
+def _new_qr_pool():
+    # forkserver: воркеры не форкаются от процесса с живыми потоками event loop
+    return ProcessPoolExecutor(
+        max_workers=os.cpu_count(),
+        mp_context=multiprocessing.get_context("forkserver"),
     )
-    qr.add_data(data)
-    img = qr.make_image(fill_color=fill, back_color=background).convert("RGBA")
-    byte_io = io.BytesIO()
-    img.save(byte_io, 'PNG')
-    byte_io.seek(0)
-    return byte_io
+
+# LRU-кэш готовых PNG живёт в основном процессе: повторный запрос не ходит в пул
+QR_CACHE_SIZE = 512
+_qr_cache = OrderedDict()
+
+
+async def generate_qr(data, fill_color="black", bg_color="white"):
+    global _QR_POOL
+    # Отдаём готовые байты PNG как есть — PTB отправляет bytes без копирования
+    key = (data, fill_color, bg_color)
+    png = _qr_cache.get(key)
+    if png is not None:
+        _qr_cache.move_to_end(key)
+        return png
+
+    loop = asyncio.get_running_loop()
+    for _ in range(2):
+        pool = _QR_POOL
+        try:
+            png = await loop.run_in_executor(pool, generate_qr_bytes, data, fill_color, bg_color)
+            break
+        except ValueError:
+            return None
+        except BrokenProcessPool:
+            # Воркер умер (например, OOM) — пул больше не работает, поднимаем новый и пробуем ещё раз
+            logging.exception("Пул генерации QR сломан, пересоздаём")
+            if _QR_POOL is pool:
+                pool.shutdown(wait=False, cancel_futures=True)
+                _QR_POOL = _new_qr_pool()
+    else:
+        return None  # Пул не поднялся и со второй попытки — просто не отвечаем картинкой
+
+    _qr_cache[key] = png
+    if len(_qr_cache) > QR_CACHE_SIZE:
+        _qr_cache.popitem(last=False)
+    return png
 
 
 # === Обработка сообщений (генерация QR-кода) ===
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    session = Session()
 
     fill_color = context.user_data.get('fill_color', 'black')
     bg_color = context.user_data.get('bg_color', 'white')
 
-    data = update.message.text
-    if '|' in data:
-        parts = data.split('|')
-        data = parts[0]
-        fill_color = parts[1] if len(parts) > 1 else fill_color
-        bg_color = parts[2] if len(parts) > 2 else bg_color
+    # Формат "текст|цвет|фон": пустые части оставляют выбранные цвета
+    data, sep, rest = update.message.text.partition('|')
+    if sep:
+        fill_part, _, rest = rest.partition('|')
+        bg_part = rest.partition('|')[0]
+        if fill_part:
+            fill_color = fill_part
+        if bg_part:
+            bg_color = bg_part
 
-    qr_image = generate_qr(data, fill_color, bg_color)
+    qr_image = await generate_qr(data, fill_color, bg_color)
 
     if qr_image:
-        history = QRHistory(
-            user_id=str(user.id),
-            data=data,
-            fill_color=fill_color,
-            bg_color=bg_color
-        )
-        session.add(history)
-        session.commit()
-        session.close()
+        _save_history(str(user.id), data, fill_color, bg_color)
 
         # ✅ Подпись с данными пользователя
         caption = f"""
@@ -275,7 +450,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             photo=qr_image,
             caption=caption,
             parse_mode='Markdown',
-            reply_markup=back_to_menu_keyboard()
+            reply_markup=BACK_KB
         )
 
         context.user_data.clear()
@@ -285,15 +460,43 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 if __name__ == '__main__':
     if not TOKEN:
         raise ValueError("TELEGRAM_BOT_TOKEN не задан в .env или в переменных окружения!")
+    if WEBHOOK_URL and not WEBHOOK_SECRET:
+        raise ValueError("Для режима вебхука задай WEBHOOK_SECRET, иначе любой сможет слать боту поддельные апдейты!")
 
     logging.basicConfig(level=logging.INFO)
-    app = ApplicationBuilder().token(TOKEN).build()
+    # Исходящие запросы к Bot API — по HTTP/2 и с таймаутами под загрузку фото (пул 256 — дефолт PTB);
+    # getUpdates PTB держит на отдельном соединении, так что long polling их не блокирует
+    request = HTTPXRequest(
+        connection_pool_size=256,
+        pool_timeout=5.0,
+        read_timeout=20,
+        write_timeout=20,
+        http_version="2",
+    )
+    app = (
+        ApplicationBuilder()
+        .token(TOKEN)
+        .request(request)
+        .post_init(init_db)
+        .post_shutdown(close_db)
+        .build()
+    )
 
     # Хэндлеры
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CallbackQueryHandler(button_handler, pattern=r'^(create_qr|show_history|help|donate|main_menu)$'))
-    app.add_handler(CallbackQueryHandler(color_button_handler, pattern=r'^(color|back_to_menu)'))
+    app.add_handler(CallbackQueryHandler(color_button_handler, pattern=r'^(c\d+|back_to_menu)$'))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
 
     print("Бот запущен...")
-    app.run_polling(drop_pending_updates=True)
\ No newline at end of file
+    if WEBHOOK_URL:
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=PORT,
+            url_path=urlparse(WEBHOOK_URL).path.lstrip("/"),
+            webhook_url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            drop_pending_updates=True,
+        )
+    else:
+        app.run_polling(drop_pending_updates=True)
\ No newline at end of file